@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 from pathlib import Path
+import shutil
 import uuid
 from flask import Flask, jsonify, render_template, request, send_file
 from werkzeug.utils import secure_filename
@@ -10,11 +11,16 @@ from .config import (
     ARTIFACTS_DIRNAME,
     CLIENTS_DIR,
     MAX_CONTENT_LENGTH,
+    UPLOAD_CHUNK_SIZE,
     UPLOADS_DIRNAME,
 )
 from .pipeline.orchestrator import run_full_pipeline
 
 
+def _noop_update(*_args, **_kwargs) -> None:
+    return None
+
+
 def create_app() -> Flask:
     app = Flask(__name__, template_folder="../templates", static_folder="../static")
     app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
@@ -57,10 +63,9 @@ def create_app() -> Flask:
         artifacts_dir.mkdir(parents=True, exist_ok=True)
 
         input_path = upload_dir / filename
-        uploaded.save(input_path)
-
-        def _noop_update(*_args, **_kwargs):
-            return None
+        # アップロードをメモリに溜めずに 1MB 単位でディスクへ書き出す
+        with open(input_path, "wb", buffering=0) as f:
+            shutil.copyfileobj(uploaded.stream, f, length=UPLOAD_CHUNK_SIZE)
 
         try:
             result = run_full_pipeline(job_id, _noop_update, client_id, job_dir, input_path)
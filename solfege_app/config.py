@@ -13,7 +13,29 @@ ARTIFACTS_DIRNAME = "artifacts"
 
 MAX_CONTENT_LENGTH = int(os.getenv("SOLFEGE_MAX_UPLOAD_BYTES", str(200 * 1024 * 1024)))
 ALLOWED_EXTENSIONS = {"mp3", "wav", "flac", "ogg", "m4a", "mp4"}
+UPLOAD_CHUNK_SIZE = 1 << 20
 MAX_WORKERS = int(os.getenv("SOLFEGE_MAX_WORKERS", "1"))
+# "process": ProcessPoolExecutor でジョブを並列実行 / "thread": 開発用の ThreadPoolExecutor
+EXECUTOR_KIND = os.getenv("SOLFEGE_EXECUTOR", "process")
+
+# UVR (audio-separator) の推論パラメータ。
+# segment_size / batch_size を既定 (256 / 1) より大きくして GPU の利用率を上げる (VRAM 6GB 以上を想定)
+UVR_MDX_PARAMS = {
+    "hop_length": 1024,
+    "segment_size": 512,
+    "overlap": 0.25,
+    "batch_size": int(os.getenv("SOLFEGE_UVR_BATCH_SIZE", "8")),
+    "enable_denoise": False,
+}
+UVR_VR_PARAMS = {
+    "batch_size": 16,
+    "window_size": 512,
+    "aggression": 5,
+    "enable_tta": False,
+    "enable_post_process": False,
+    "post_process_threshold": 0.2,
+    "high_end_process": False,
+}
 
 MIDI_OFFSET = 21
 HOP_LENGTH = constants.FFT_HOP
@@ -1,13 +1,20 @@
 from __future__ import annotations
 
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass, field
 from datetime import datetime
+from functools import partial
+import multiprocessing
 from pathlib import Path
 from threading import Lock
-from typing import Any, Callable
+from typing import Any, Callable, MutableMapping
 import uuid
 
+from .config import EXECUTOR_KIND
+
+# これらの状態になったジョブには，以降の進捗更新を反映しない
+_TERMINAL_STATUSES = frozenset({"completed", "failed"})
+
 
 @dataclass
 class JobRecord:
@@ -24,11 +31,51 @@ class JobRecord:
     error: str | None = None
 
 
+class _SharedProgress:
+    """ワーカープロセスから共有 dict に進捗を書き込む update_job (picklable)。"""
+
+    def __init__(self, store: MutableMapping[str, dict[str, Any]]) -> None:
+        self._store = store
+
+    def __call__(self, job_id: str, **kwargs: Any) -> None:
+        current = self._store.get(job_id, {})
+        current.update(kwargs)
+        self._store[job_id] = current
+
+
+def _init_worker() -> None:
+    """ジョブごとの import・モデル読み込みコストを避けるため，ワーカー起動時に重い依存を読み込んでおく。"""
+    import librosa  # noqa: F401
+    import torch  # noqa: F401
+
+    from .pipeline import orchestrator  # noqa: F401
+    from .pipeline.pitch_inference import load_model
+
+    load_model()
+
+
+def _run_in_worker(
+    job_id: str, update_job: _SharedProgress, func: Callable[..., dict[str, Any]], *args: Any
+) -> dict[str, Any]:
+    update_job(job_id, status="running", step="starting", progress=0.01)
+    return func(job_id, update_job, *args)
+
+
 class JobManager:
-    def __init__(self, max_workers: int = 1) -> None:
-        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+    def __init__(self, max_workers: int = 1, executor: str = EXECUTOR_KIND) -> None:
         self._jobs: dict[str, JobRecord] = {}
         self._lock = Lock()
+        self._progress: MutableMapping[str, dict[str, Any]] | None = None
+        if executor == "thread":
+            self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        else:
+            methods = multiprocessing.get_all_start_methods()
+            ctx = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            self._manager = ctx.Manager()
+            self._progress = self._manager.dict()
+            self._executor = ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=ctx, initializer=_init_worker
+            )
 
     def _now(self) -> str:
         return datetime.utcnow().isoformat() + "Z"
@@ -49,7 +96,17 @@ class JobManager:
         return record
 
     def submit(self, record: JobRecord, func: Callable[..., dict[str, Any]], *args: Any) -> None:
-        self._executor.submit(self._run, record.job_id, func, *args)
+        """func(job_id, update_job, *args) を実行する。
+
+        プロセス実行時は func と args が pickle 可能である必要がある (モジュールレベル関数など)。
+        """
+        if self._progress is None:
+            self._executor.submit(self._run, record.job_id, func, *args)
+            return
+        future = self._executor.submit(
+            _run_in_worker, record.job_id, _SharedProgress(self._progress), func, *args
+        )
+        future.add_done_callback(partial(self._finish, record.job_id))
 
     def _run(self, job_id: str, func: Callable[..., dict[str, Any]], *args: Any) -> None:
         self.update(job_id, status="running", step="starting", progress=0.01)
@@ -59,14 +116,42 @@ class JobManager:
         except Exception as exc:
             self.update(job_id, status="failed", step="failed", error=str(exc), message=str(exc))
 
+    def _finish(self, job_id: str, future: Future) -> None:
+        self._sync_progress(job_id)
+        self._progress.pop(job_id, None)
+        exc = future.exception()
+        if exc is None:
+            self.update(job_id, status="completed", step="completed", progress=1.0, result=future.result())
+        else:
+            self.update(job_id, status="failed", step="failed", error=str(exc), message=str(exc))
+
+    def _sync_progress(self, job_id: str) -> None:
+        """ワーカーが共有 dict に書いた進捗を JobRecord に反映する。
+
+        _finish との競合で古い進捗を書き戻さないよう，読み出しと反映を同じロック内で行う。
+        """
+        if self._progress is None:
+            return
+        with self._lock:
+            job = self._jobs.get(job_id)
+            shared = self._progress.get(job_id)
+            if job is not None and shared:
+                self._apply(job, shared)
+
+    def _apply(self, job: JobRecord, fields: dict[str, Any]) -> None:
+        """self._lock を保持した状態で呼ぶ。完了・失敗済みのジョブは更新しない。"""
+        if job.status in _TERMINAL_STATUSES:
+            return
+        for key, value in fields.items():
+            if hasattr(job, key):
+                setattr(job, key, value)
+        job.updated_at = self._now()
+
     def update(self, job_id: str, **kwargs: Any) -> None:
         with self._lock:
-            job = self._jobs[job_id]
-            for key, value in kwargs.items():
-                if hasattr(job, key):
-                    setattr(job, key, value)
-            job.updated_at = self._now()
+            self._apply(self._jobs[job_id], kwargs)
 
     def get(self, job_id: str) -> JobRecord | None:
+        self._sync_progress(job_id)
         with self._lock:
             return self._jobs.get(job_id)
\ No newline at end of file
@@ -4,36 +4,65 @@ basic-pitch のフレーム単位の出力をビートグリッドに量子化
 """
 from __future__ import annotations
 
+from functools import lru_cache
+
 import numpy as np
 import librosa
 from basic_pitch import constants as bp_constants
 from .. import config
 
+try:
+    from madmom.features.beats import DBNBeatTrackingProcessor, RNNBeatProcessor
+except ImportError:  # madmom 未導入時は librosa でビート検出する
+    DBNBeatTrackingProcessor = RNNBeatProcessor = None
+
 HOP_LENGTH = bp_constants.FFT_HOP
 SAMPLING_RATE = bp_constants.AUDIO_SAMPLE_RATE
 SECONDS_PER_FRAME = HOP_LENGTH / SAMPLING_RATE
 
+# madmom の RNN ビート検出器の入力サンプリングレートと出力フレームレート
+MADMOM_SAMPLE_RATE = 44100
+MADMOM_FPS = 100
+
+
+@lru_cache(maxsize=64)
+def _hamming_window(length: int) -> tuple[np.ndarray, np.float32]:
+    """長さごとのハミング窓 (float32, 読み取り専用) と 1 / 窓の和を返す。"""
+    weights = np.hamming(length).astype(np.float32)
+    weights.setflags(write=False)
+    return weights, np.float32(1.0) / weights.sum()
+
 
 def center_weighted_agg_func(array: np.ndarray, axis: int = 0) -> np.ndarray:
     """配列の中心に重みを置いて集約する (ハミング窓)。"""
-    length = array.shape[axis]
-    weights = np.hamming(length)
+    weights, inv_sum = _hamming_window(array.shape[axis])
     if axis == 0:
-        weighted = array * weights[:, np.newaxis]
+        weighted_sum = weights @ array
     else:
-        weighted = array * weights[np.newaxis, :]
-    return np.sum(weighted, axis=axis) / np.sum(weights)
+        weighted_sum = array @ weights
+    return weighted_sum * inv_sum
 
-def detect_beats(
-    y: np.ndarray, sr: int, hop_length: int = HOP_LENGTH
+@lru_cache(maxsize=None)
+def _rnn_beat_processor():
+    """RNNBeatProcessor (モデル重みの読み込みを伴う) を使い回す。"""
+    return RNNBeatProcessor()
+
+
+def _detect_beats_madmom(y: np.ndarray, sr: int) -> np.ndarray:
+    """madmom の RNN + DBN でビート時刻（秒）を検出する。"""
+    y_resampled = librosa.resample(y, orig_sr=sr, target_sr=MADMOM_SAMPLE_RATE)
+    activations = _rnn_beat_processor()(y_resampled)
+    return DBNBeatTrackingProcessor(fps=MADMOM_FPS)(activations)
+
+
+def _detect_beats_librosa(
+    y: np.ndarray, sr: int, hop_length: int
 ) -> tuple[float, np.ndarray]:
-    """
-    テンポとビートフレーム位置を検出する。
-    Returns:
-        midi_tempo: estimated tempo in BPM
-        beat_frames: array of beat positions in frames
-    """
-    tempo_arr = librosa.feature.tempo(y=y, sr=sr)
+    # テンポ推定とビート追跡で同じオンセット包絡 (メルスペクトログラム1回分) を使い回す
+    onset_env = librosa.onset.onset_strength(
+        y=y, sr=sr, hop_length=hop_length, aggregate=np.median
+    )
+    tempo_arr = librosa.feature.tempo(onset_envelope=onset_env, sr=sr, hop_length=hop_length)
     if tempo_arr.size:
         start_bpm = float(tempo_arr[0])
     else:
@@ -41,20 +70,87 @@ def detect_beats(
         raise ValueError("Tempo cannot be detected.")
         # start_bpm = 120.0
     tempo, beat_frames = librosa.beat.beat_track(
-        y=y, sr=sr, hop_length=hop_length, start_bpm=start_bpm, units="frames"
+        onset_envelope=onset_env, sr=sr, hop_length=hop_length, start_bpm=start_bpm, units="frames"
     )
     midi_tempo = float(tempo[0]) if np.asarray(tempo).size else start_bpm
-    print(f"Detected tempo: {float(tempo[0])} BPM, {len(beat_frames)} beats")
     return midi_tempo, beat_frames
 
 
+def detect_beats(
+    y: np.ndarray, sr: int, hop_length: int = HOP_LENGTH
+) -> tuple[float, np.ndarray]:
+    """
+    テンポとビートフレーム位置を検出する。
+    madmom が利用可能なら RNN + DBN ビートトラッカーを使い、
+    なければ (またはビートが2つ未満なら) librosa で検出する。
+    Returns:
+        midi_tempo: estimated tempo in BPM
+        beat_frames: array of beat positions in frames
+    """
+    beat_times = None
+    if RNNBeatProcessor is not None:
+        beat_times = _detect_beats_madmom(y, sr)
+
+    if beat_times is not None and len(beat_times) >= 2:
+        midi_tempo = 60.0 / float(np.median(np.diff(beat_times)))
+        beat_frames = librosa.time_to_frames(beat_times, sr=sr, hop_length=hop_length)
+    else:
+        midi_tempo, beat_frames = _detect_beats_librosa(y, sr, hop_length)
+    print(f"Detected tempo: {midi_tempo} BPM, {len(beat_frames)} beats")
+    return midi_tempo, beat_frames
+
+
+def _grid_bounds(
+    beat_times_sec: np.ndarray,
+    total_duration: float,
+    subdivisions: int,
+) -> tuple[np.ndarray, np.ndarray]:
+    """各グリッドの開始・終了時刻（秒）を返す。
+
+    ビート間（先頭は 0 秒から、末尾は最後のビートから total_duration まで）を
+    subdivisions で等分割し、長さが正の区間のみを残す。
+    """
+    beats = np.asarray(beat_times_sec, dtype=np.float64)
+    seg_starts = np.concatenate(([0.0], beats))
+    seg_ends = np.concatenate((beats, [total_duration]))
+    # (num_segments, subdivisions + 1)
+    sub_times = np.linspace(seg_starts, seg_ends, subdivisions + 1, axis=1)
+    t_starts = sub_times[:, :-1].ravel()
+    t_ends = sub_times[:, 1:].ravel()
+    keep = t_ends > t_starts
+    return t_starts[keep], t_ends[keep]
+
+
+def _reduce_bins(
+    data: np.ndarray,
+    f_starts: np.ndarray,
+    f_ends: np.ndarray,
+    ufunc: np.ufunc,
+) -> np.ndarray | None:
+    """各区間 data[f_start:f_end] を ufunc.reduceat でまとめて集約する。
+
+    区間は空でないことを前提とする。終端フレームに届く区間が最後以外にある場合は
+    reduceat で表現できないため None を返す。
+    """
+    bounds = np.empty(2 * len(f_starts), dtype=np.intp)
+    bounds[0::2] = f_starts
+    bounds[1::2] = f_ends
+    # reduceat は最後の区間を data の終端まで集約するので、終端インデックスは不要
+    if bounds[-1] == data.shape[0]:
+        bounds = bounds[:-1]
+    if bounds.size and bounds.max() >= data.shape[0]:
+        return None
+    # 偶数番目が [f_start, f_end) の集約結果
+    return ufunc.reduceat(data, bounds, axis=0)[0::2]
+
+
 def quantize_to_grid(
     data: np.ndarray,
     beat_times_sec: np.ndarray,
     spf: float,
     subdivisions: int = 4,
     agg_func=np.mean,
-) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+) -> tuple[np.ndarray, np.ndarray]:
     """
     フレームデータをビートグリッドに量子化する（実時間ベース）．
     data: (num_frames, num_features)
@@ -62,53 +158,35 @@ def quantize_to_grid(
     spf: seconds per frame (データ配列のフレーム→秒変換用)
     subdivisions: 1ビートあたりの分割数
     agg_func: 集約関数 (np.max, np.mean等). signature: func(array, axis=int)
-    Returns: (grid_values, grid_times) - grid_times は秒（float）
+    Returns: (grid_values, grid_times) - grid_values は float32, grid_times は秒（float64）
     """
     end_frame = data.shape[0]
     total_duration = end_frame * spf
-    grid_values = []
-    grid_times = []  # 実時間（秒）
-    prev_beat_time = 0.0
-
-    for beat_time in list(beat_times_sec):
-        # ビート間をsubdivisionsで等分割（秒単位、floatのまま）
-        sub_times = np.linspace(prev_beat_time, beat_time, subdivisions + 1)
-        for j in range(subdivisions):
-            t_start, t_end = sub_times[j], sub_times[j + 1]
-            if t_end <= t_start:
-                continue
-            # 実時間からフレームインデックスに変換（集約範囲の特定のみ）
-            f_start = int(round(t_start / spf))
-            f_end = int(round(t_end / spf))
-            f_start = min(f_start, end_frame)
-            f_end = min(f_end, end_frame)
-
-            if f_start >= end_frame or f_end <= f_start:
-                grid_values.append(np.zeros(data.shape[1]))
-            else:
-                chunk = data[f_start:f_end]
-                if chunk.shape[0] == 0:
-                    grid_values.append(np.zeros(data.shape[1]))
-                else:
-                    grid_values.append(agg_func(chunk, axis=0))
-            grid_times.append(t_start)  # グリッドの正確な実時間を保持
-        prev_beat_time = beat_time
-
-    # 最後のビート以降
-    if prev_beat_time < total_duration:
-        sub_times = np.linspace(prev_beat_time, total_duration, subdivisions + 1)
-        for j in range(subdivisions):
-            t_start, t_end = sub_times[j], sub_times[j + 1]
-            if t_end <= t_start:
-                continue
-            f_start = int(round(t_start / spf))
-            f_end = int(round(t_end / spf))
-            f_start = min(f_start, end_frame)
-            f_end = min(f_end, end_frame)
-            if f_start < end_frame and f_end > f_start:
-                grid_values.append(agg_func(data[f_start:f_end], axis=0))
-            else:
-                grid_values.append(np.zeros(data.shape[1]))
-            grid_times.append(t_start)
-
-    return np.array(grid_values), np.array(grid_times, dtype=np.float64)
\ No newline at end of file
+    t_starts, t_ends = _grid_bounds(beat_times_sec, total_duration, subdivisions)
+
+    # 実時間からフレームインデックスに変換（集約範囲の特定のみ）
+    f_starts = np.minimum(np.round(t_starts / spf).astype(np.intp), end_frame)
+    f_ends = np.minimum(np.round(t_ends / spf).astype(np.intp), end_frame)
+    # 範囲外・空の区間は 0 とする
+    valid = (f_starts < end_frame) & (f_ends > f_starts)
+    s, e = f_starts[valid], f_ends[valid]
+
+    reduced = None
+    if s.size and (agg_func is np.mean or agg_func is np.max or agg_func is np.amax):
+        if agg_func is np.mean:
+            sums = _reduce_bins(data, s, e, np.add)
+            if sums is not None:
+                reduced = sums / (e - s)[:, np.newaxis]
+        else:
+            reduced = _reduce_bins(data, s, e, np.maximum)
+
+    if reduced is None:
+        # 任意の集約関数は区間ごとに適用する
+        reduced = np.array([agg_func(data[a:b], axis=0) for a, b in zip(s, e)])
+
+    grid_values = np.zeros((len(t_starts), data.shape[1]), dtype=np.float32)
+    if s.size:
+        grid_values[valid] = reduced
+
+    # グリッドの正確な実時間を保持
+    return grid_values, t_starts
@@ -0,0 +1,87 @@
+"""HPSS (調波・打楽器音分離) モジュール。
+
+CUDA が利用可能な場合は torch 上で STFT・メディアンフィルタ・ソフトマスクを計算し、
+利用できない場合は librosa.effects.hpss にフォールバックする。
+どちらも librosa.effects.hpss の既定パラメータ (n_fft=2048, hop=512, kernel_size=31, power=2) に従う。
+"""
+from __future__ import annotations
+
+import librosa
+import numpy as np
+import torch
+
+N_FFT = 2048
+HPSS_HOP_LENGTH = 512
+KERNEL_SIZE = 31
+# メディアンフィルタの一時領域 (行数 × 列数 × KERNEL_SIZE) を抑えるための分割幅
+_CHUNK = 128
+
+
+def _gpu_device() -> torch.device | None:
+    return torch.device("cuda") if torch.cuda.is_available() else None
+
+
+def _median_filter(x: torch.Tensor, size: int, dim: int) -> torch.Tensor:
+    """x (freq, time) の dim 方向にメディアンフィルタをかける (scipy の mode="reflect" 相当)。"""
+    half = size // 2
+    if dim == 0:
+        return _median_filter(x.T, size, dim=1).T
+
+    # 端の値を含めて折り返す (d c b a | a b c d | d c b a)。
+    # フレーム数が half 未満でも scipy と同じく折り返しを繰り返す (周期 2n)
+    n = x.shape[1]
+    idx = torch.arange(-half, n + half, device=x.device).remainder(2 * n)
+    idx = torch.where(idx >= n, 2 * n - 1 - idx, idx)
+    padded = x[:, idx]
+    out = torch.empty_like(x)
+    for i in range(0, x.shape[0], _CHUNK):
+        windows = padded[i:i + _CHUNK].unfold(1, size, 1)  # (rows, time, size)
+        out[i:i + _CHUNK] = windows.median(dim=-1).values
+    return out
+
+
+def _softmask(x: torch.Tensor, x_ref: torch.Tensor, split_zeros: bool) -> torch.Tensor:
+    """librosa.util.softmask (power=2) 相当。"""
+    z = torch.maximum(x, x_ref)
+    bad = z < torch.finfo(z.dtype).tiny
+    z = torch.where(bad, torch.ones_like(z), z)
+    mask = (x / z) ** 2
+    ref_mask = (x_ref / z) ** 2
+    mask = mask / (mask + ref_mask)
+    return torch.where(bad, torch.full_like(mask, 0.5 if split_zeros else 0.0), mask)
+
+
+def _harmonic_torch(y: np.ndarray, margin: float, device: torch.device) -> np.ndarray:
+    x = torch.from_numpy(np.ascontiguousarray(y, dtype=np.float32)).to(device)
+    window = torch.hann_window(N_FFT, device=device)
+    stft = torch.stft(
+        x, N_FFT, hop_length=HPSS_HOP_LENGTH, window=window,
+        center=True, pad_mode="constant", return_complex=True,
+    )
+    mag = stft.abs()
+    harm = _median_filter(mag, KERNEL_SIZE, dim=1)  # 時間方向
+    perc = _median_filter(mag, KERNEL_SIZE, dim=0)  # 周波数方向
+    mask_harm = _softmask(harm, perc * margin, split_zeros=margin == 1)
+    y_harm = torch.istft(
+        stft * mask_harm, N_FFT, hop_length=HPSS_HOP_LENGTH, window=window,
+        center=True, length=x.shape[-1],
+    )
+    return y_harm.cpu().numpy()
+
+
+def extract_harmonic(y: np.ndarray, margin: float = 1.0) -> np.ndarray:
+    """y の調波成分を返す。
+
+    Parameters
+    ----------
+    y : モノラル音声信号
+    margin : librosa.effects.hpss の margin (>= 1.0)
+
+    Returns: y と同じ長さの float32 信号
+    """
+    y = np.asarray(y, dtype=np.float32)
+    device = _gpu_device()
+    if device is None:
+        y_harmonic, _ = librosa.effects.hpss(y, margin=margin)
+        return y_harmonic.astype(np.float32, copy=False)
+    return _harmonic_torch(y, margin, device)
@@ -5,12 +5,15 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
+from functools import lru_cache
 
 import librosa
 import numpy as np
+from numba import njit
 from scipy.ndimage import gaussian_filter1d
 
 from .beat_grid import HOP_LENGTH, quantize_to_grid
+from .hpss import extract_harmonic
 from .. import config
 
 
@@ -25,18 +28,25 @@ class KeyEstimate:
     key_index: int     # 0–23 (0–11: Major, 12–23: Minor)
 
 
+@lru_cache(maxsize=None)
 def _build_key_templates() -> np.ndarray:
-    """24キーの正規化済みテンプレート (24, 12)。"""
+    """24キーの正規化済みテンプレート (24, 12, float32)。
+
+    config の定数のみに依存するため初回呼び出し時の結果を使い回す (読み取り専用)。
+    """
     templates_major = np.array([np.roll(config.MAJOR_PROFILE, i) for i in range(12)])
     templates_minor = np.array([np.roll(config.MINOR_PROFILE, i) for i in range(12)])
     key_templates = np.vstack([templates_major, templates_minor])
     centered = key_templates - key_templates.mean(axis=1, keepdims=True)
     norms = np.linalg.norm(centered, axis=1, keepdims=True) + 1e-10
-    return centered / norms
+    templates = (centered / norms).astype(np.float32)
+    templates.setflags(write=False)
+    return templates
 
 
+@lru_cache(maxsize=None)
 def _build_transition_matrix(n_states: int = 24) -> np.ndarray:
-    """キー遷移行列を構築する。"""
+    """キー遷移行列を構築する (n_states ごとにキャッシュ、読み取り専用)。"""
     STABLE_PROB = config.KEY_ESTIMATION_HMM_PARAMS["STABLE_PROB"]
     RELATIVE_PROB = config.KEY_ESTIMATION_HMM_PARAMS["RELATIVE_PROB"]
     FIFTH_PROB = config.KEY_ESTIMATION_HMM_PARAMS["FIFTH_PROB"]
@@ -61,9 +71,70 @@ def _build_transition_matrix(n_states: int = 24) -> np.ndarray:
         trans[m, i] = PARALLEL_PROB # 同主調
 
     trans /= trans.sum(axis=1, keepdims=True)
+    trans.setflags(write=False)
     return trans
 
 
+@lru_cache(maxsize=None)
+def _build_log_transition_matrix(n_states: int = 24) -> np.ndarray:
+    """対数キー遷移行列 (読み取り専用)。"""
+    log_trans = np.log(_build_transition_matrix(n_states))
+    log_trans.setflags(write=False)
+    return log_trans
+
+
+@njit(cache=True)
+def _viterbi(
+    log_emit: np.ndarray,
+    log_trans: np.ndarray,
+    log_init: np.ndarray,
+) -> np.ndarray:
+    """対数領域の Viterbi デコード (Numba)。
+
+    log_emit : (T, n_states) 対数出力確率
+    log_trans : (n_states, n_states) log_trans[i, j] = log P(j | i)
+    log_init : (n_states,) 対数初期確率
+    """
+    T, n_states = log_emit.shape
+    path = np.zeros(T, dtype=np.int64)
+    if T == 0:
+        return path
+    backptr = np.zeros((T, n_states), dtype=np.int32)
+    delta = log_init + log_emit[0]
+    new_delta = np.empty(n_states, dtype=np.float64)
+
+    for t in range(1, T):
+        for s in range(n_states):
+            best = delta[0] + log_trans[0, s]
+            arg = 0
+            for p in range(1, n_states):
+                v = delta[p] + log_trans[p, s]
+                if v > best:
+                    best = v
+                    arg = p
+            new_delta[s] = best + log_emit[t, s]
+            backptr[t, s] = arg
+        delta[:] = new_delta
+
+    # バックトラック
+    path[T - 1] = np.argmax(delta)
+    for t in range(T - 1, 0, -1):
+        path[t - 1] = backptr[t, path[t]]
+    return path
+
+
+def _warmup() -> None:
+    """初回リクエストで JIT コンパイルが走らないよう、import 時にコンパイルしておく。
+
+    Numba は読み取り専用配列を別の型として扱うので、遷移行列は実際の呼び出しと同じ
+    キャッシュ済み (読み取り専用) の配列を渡す。
+    """
+    _viterbi(np.zeros((2, 24)), _build_log_transition_matrix(n_states=24), np.zeros(24))
+
+
+_warmup()
+
+
 def estimate_key_sequence(
     y_original: np.ndarray,
     sr: int,
@@ -71,6 +142,7 @@ def estimate_key_sequence(
     beat_times_sec: np.ndarray,
     block_size: int = 4,
     filter_sigma: float = 4.0,
+    skip_hpss: bool = False,
 ) -> tuple[np.ndarray, KeyEstimate]:
     """時間変化するキー系列を推定する。
 
@@ -82,13 +154,15 @@ def estimate_key_sequence(
     beat_times_sec : ビートタイム配列
     block_size : HMM ブロックサイズ（グリッド数）
     filter_sigma : ガウシアンフィルタの sigma
+    skip_hpss : True の場合 HPSS を省略して y_original をそのまま使う
+        (Demucs でドラムを除いたステムなど、打楽器成分を含まない入力向け)
 
     Returns
     -------
-    key_sequence : (num_grids,) — 各グリッドのキーインデックス (0–23)
+    key_sequence : (num_grids,) int16 — 各グリッドのキーインデックス (0–23)
     global_key : 曲全体の推定キー
     """
-    y_harmonic, _ = librosa.effects.hpss(y_original, margin=1.0)
+    y_harmonic = y_original if skip_hpss else extract_harmonic(y_original, margin=1.0)
 
     # --- クロマ特徴量の獲得 ---
     chroma = librosa.feature.chroma_cqt(
@@ -116,38 +190,43 @@ def estimate_key_sequence(
     )
 
     # --- ブロック化 ---
+    # ブロック(block_size=4 => 1 拍)ごとに集約する
+    # 末尾の不足分は最終グリッドの値で埋めたものとして扱う (np.pad の mode="edge" 相当)
     original_length = grid_chroma_filtered.shape[0]
     pad_width = (block_size - (original_length % block_size)) % block_size
-    padded = np.pad(grid_chroma_filtered, ((0, pad_width), (0, 0)), mode="edge")
-    # ブロック(block_size=4 => 1 拍)ごとに集約する
-    coarse_chroma = padded.reshape(-1, block_size, 12).mean(axis=1) # shape: (num_blocks, 12)
+    block_starts = np.arange(0, original_length, block_size)
+    coarse_chroma = np.add.reduceat(grid_chroma_filtered, block_starts, axis=0) # shape: (num_blocks, 12)
+    if pad_width:
+        coarse_chroma[-1] += pad_width * grid_chroma_filtered[-1]
+    coarse_chroma *= 1.0 / block_size
 
     # --- キー推定 ---
     # ピアソン相関を用いて，各ブロックとキーの類似度を推定する
     template_norm = _build_key_templates() # (24, 12)
-    chroma_centered = coarse_chroma - coarse_chroma.mean(axis=1, keepdims=True) # (num_blocks, 12)
-    chroma_norm = chroma_centered / (np.linalg.norm(chroma_centered, axis=1, keepdims=True) + 1e-10) # (num_blocks, 12)
-    correlation = chroma_norm @ template_norm.T # (num_blocks, 24)
+    coarse_chroma -= coarse_chroma.mean(axis=1, keepdims=True) # 中心化 (in-place)
+    chroma_norms = np.sqrt(np.einsum("bc,bc->b", coarse_chroma, coarse_chroma)) # (num_blocks,)
+    correlation = coarse_chroma @ template_norm.T # (num_blocks, 24)
+    correlation /= chroma_norms[:, np.newaxis] + 1e-10
 
     # グローバルキーの推定
     total_corr = correlation.sum(axis=0)
     global_key_idx = int(np.argmax(total_corr))
 
-    # 確率変換 (Soft-max)
-    key_prob = np.exp(correlation)
-    key_prob /= key_prob.sum(axis=1, keepdims=True)
+    # 確率変換 (Soft-max, 対数領域)
+    correlation = correlation.astype(np.float64)
+    log_key_prob = correlation - np.log(np.exp(correlation).sum(axis=1, keepdims=True))
 
     # --- Viterbiアルゴリズムによるキー系列の推定 ---
-    transition = _build_transition_matrix(n_states=24) # (24, 24)
+    log_transition = _build_log_transition_matrix(n_states=24) # (24, 24)
     p_init = np.ones(24) * 0.1
     # グローバルキーの初期確率を補正
     p_init[global_key_idx] = 0.30
     p_init /= p_init.sum()
-    # Viterbiアルゴリズム実行
-    key_seq_coarse = librosa.sequence.viterbi(key_prob.T, transition, p_init=p_init)
+    # Viterbiアルゴリズム実行 (float64)
+    key_seq_coarse = _viterbi(log_key_prob, log_transition, np.log(p_init))
 
     # 元の解像度に復元
-    key_sequence = np.repeat(key_seq_coarse, block_size)[:original_length]
+    key_sequence = np.repeat(key_seq_coarse.astype(np.int16), block_size)[:original_length]
 
     # グローバルキー
     root_pc = global_key_idx % 12
@@ -163,40 +242,53 @@ def estimate_key_sequence(
     return key_sequence, global_key
 
 
+def _build_interval_weights(intervals: list[int], extra: dict[int, float]) -> np.ndarray:
+    """主音からの音程 (0–11) ごとの重み (12,)。"""
+    weights = np.full(12, 0.6) # スケール外の音を抑制
+    for interval, weight in extra.items():
+        weights[interval] = weight
+    weights[intervals] = 1.2 # スケール構成音を優遇
+    return weights
+
+
+# 音程 → 重みの LUT
+_MAJOR_INTERVAL_WEIGHTS = _build_interval_weights([0, 2, 4, 5, 7, 9, 11], {}) # Major
+_MINOR_INTERVAL_WEIGHTS = _build_interval_weights(
+    [0, 2, 3, 5, 7, 8, 10], # Natural Minor
+    {6: 0.9, 11: 0.9}, # メロディックマイナー特徴音
+)
+
+
 def get_scale_mask(
     key_idx: int, n_pitches: int = 88, midi_offset: int = 21,
 ) -> np.ndarray:
     """キーのスケール構成音に基づく重みマスクを返す。"""
     root = key_idx % 12 # 主音
-    is_minor = key_idx >= 12
+    weights = _MINOR_INTERVAL_WEIGHTS if key_idx >= 12 else _MAJOR_INTERVAL_WEIGHTS
+    relative_pitch = (np.arange(n_pitches) + midi_offset - root) % 12
+    return weights[relative_pitch]
 
-    if is_minor:
-        intervals = {0, 2, 3, 5, 7, 8, 10} # Natural Minor
-    else:
-        intervals = {0, 2, 4, 5, 7, 9, 11} # Major
 
-    mask = np.ones(n_pitches)
-    for i in range(n_pitches):
-        midi_note = i + midi_offset
-        pitch_class = midi_note % 12
-        relative_pitch = (pitch_class - root + 12) % 12
+def _build_scale_mask_table(n_pitches: int = 88, midi_offset: int = 21) -> np.ndarray:
+    """24キー分のスケールマスク (24, n_pitches)。"""
+    return np.stack(
+        [get_scale_mask(k, n_pitches, midi_offset) for k in range(24)]
+    ).astype(np.float32)
 
-        if relative_pitch in intervals:
-            mask[i] = 1.2 # スケール構成音を優遇
-        elif is_minor and relative_pitch in {6, 11}:
-            mask[i] = 0.9 # メロディックマイナー特徴音
-        else:
-            mask[i] = 0.6 # スケール外の音を抑制
 
-    return mask
+_SCALE_MASK_TABLE = _build_scale_mask_table(88, config.MIDI_OFFSET)
 
 
 def apply_scale_bias(
     grid_notes: np.ndarray,
     grid_onsets: np.ndarray,
     key_sequence: np.ndarray,
+    inplace: bool = False,
 ) -> tuple[np.ndarray, np.ndarray]:
-    """キー系列に基づくスケールバイアスをノート確率に適用する。"""
+    """キー系列に基づくスケールバイアスをノート確率に適用する。
+
+    inplace=True の場合は grid_notes / grid_onsets を直接書き換えて返す。
+    """
     n_grids, n_pitches = grid_notes.shape
 
     # key_sequence の長さ合わせ
@@ -207,11 +299,14 @@ def apply_scale_bias(
     else:
         key_seq = key_sequence
 
-    biased_notes = grid_notes.copy()
-    biased_onsets = grid_onsets.copy()
-    for t in range(n_grids):
-        mask = get_scale_mask(int(key_seq[t]), n_pitches, config.MIDI_OFFSET)
-        biased_notes[t] *= mask
-        biased_onsets[t] *= mask
+    if n_pitches == _SCALE_MASK_TABLE.shape[1]:
+        mask_table = _SCALE_MASK_TABLE
+    else:
+        mask_table = _build_scale_mask_table(n_pitches, config.MIDI_OFFSET)
+    masks = mask_table[np.asarray(key_seq, dtype=np.intp)] # (n_grids, n_pitches)
 
+    biased_notes = grid_notes if inplace else np.empty_like(grid_notes)
+    biased_onsets = grid_onsets if inplace else np.empty_like(grid_onsets)
+    np.multiply(grid_notes, masks, out=biased_notes)
+    np.multiply(grid_onsets, masks, out=biased_onsets)
     return biased_notes, biased_onsets
@@ -4,81 +4,346 @@
 """
 from __future__ import annotations
 
+from dataclasses import dataclass
+
 import numpy as np
-import librosa
-from scipy.ndimage import gaussian_filter1d, uniform_filter1d
+from numba import njit
 
 from .. import config
 
 
-def _extract_diagonal_runs(
+@dataclass
+class MotifSegments:
+    """モチーフ区間 (SoA)。i 番目の要素が区間 A=[start_a, start_a+length) と B=[start_b, start_b+length) の対応を表す。"""
+    start_a: np.ndarray
+    start_b: np.ndarray
+    length: np.ndarray
+    score: np.ndarray
+
+    @classmethod
+    def empty(cls) -> MotifSegments:
+        idx = np.empty(0, dtype=np.int64)
+        return cls(idx, idx, idx, np.empty(0, dtype=np.float64))
+
+    def __len__(self) -> int:
+        return self.start_a.shape[0]
+
+    def take(self, index: np.ndarray) -> MotifSegments:
+        return MotifSegments(
+            self.start_a[index], self.start_b[index], self.length[index], self.score[index]
+        )
+
+
+@njit(cache=True)
+def _scan_diagonals(
+    R_bin: np.ndarray,
     R_aff: np.ndarray,
-    R_binary: np.ndarray
-) -> list[dict]:
-    """二値再帰行列の対角線上の連続区間を抽出する。"""
-    n = R_binary.shape[0]
-    segments: list[dict] = []
-
-    for offset in range(config.REC_WIDTH, n):
-        diag_bin = np.diagonal(R_binary, offset=offset)
-        if diag_bin.size < config.REC_MIN_LEN:
-            continue
+    width: int,
+    min_len: int,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """上三角を行優先で1回走査し、各対角線上の連続区間を抽出する (Numba)。
+
+    Returns
+    -------
+    (start_a, offset, length, score) — 長さ min_len 以上の区間
+    """
+    n = R_bin.shape[0]
+    # 1本の対角線 (長さ L) に入る区間数は高々 (L + 1) // (min_len + 1)
+    capacity = 0
+    for offset in range(width, n):
+        capacity += (n - offset + 1) // (min_len + 1)
+
+    out_start = np.empty(capacity, dtype=np.int64)
+    out_offset = np.empty(capacity, dtype=np.int64)
+    out_len = np.empty(capacity, dtype=np.int64)
+    out_score = np.empty(capacity, dtype=np.float64)
+    count = 0
+
+    # 対角線 (offset) ごとの走査中の区間の開始位置 (-1: 区間外) と類似度の和
+    run_start = np.full(n, -1, dtype=np.int64)
+    run_sum = np.zeros(n, dtype=np.float64)
+
+    for i in range(n):
+        for j in range(i + width, n):
+            offset = j - i
+            if R_bin[i, j]:
+                if run_start[offset] < 0:
+                    run_start[offset] = i
+                    run_sum[offset] = 0.0
+                run_sum[offset] += R_aff[i, j]
+            elif run_start[offset] >= 0:
+                length = i - run_start[offset]
+                if length >= min_len:
+                    out_start[count] = run_start[offset]
+                    out_offset[count] = offset
+                    out_len[count] = length
+                    out_score[count] = run_sum[offset] / length
+                    count += 1
+                run_start[offset] = -1
+
+    # 対角線の終端まで続いた区間
+    for offset in range(width, n):
+        if run_start[offset] >= 0:
+            length = (n - offset) - run_start[offset]
+            if length >= min_len:
+                out_start[count] = run_start[offset]
+                out_offset[count] = offset
+                out_len[count] = length
+                out_score[count] = run_sum[offset] / length
+                count += 1
+
+    return out_start[:count], out_offset[:count], out_len[:count], out_score[:count]
 
-        padded = np.concatenate(([0], diag_bin, [0]))
-        diffs = np.diff(padded)
-        starts = np.where(diffs == 1)[0]
-        ends = np.where(diffs == -1)[0]
 
-        for start, end in zip(starts, ends):
-            length = end - start
-            if length >= config.REC_MIN_LEN:
-                diag_aff = np.diagonal(R_aff, offset=offset)
-                score = float(np.mean(diag_aff[start:end]))
-                segments.append({
-                    "start_a": int(start),
-                    "start_b": int(start + offset),
-                    "length": int(length),
-                    "score": score,
-                })
+def _extract_diagonal_runs(
+    R_aff: np.ndarray,
+    R_binary: np.ndarray
+) -> MotifSegments:
+    """二値再帰行列の対角線上の連続区間を抽出する。
 
-    segments.sort(key=lambda s: (s["score"] * s["length"], s["length"]), reverse=True)
-    return segments
+    Returns
+    -------
+    score * length, length の降順に並べた区間
+    """
+    start_a, offset, length, score = _scan_diagonals(
+        np.ascontiguousarray(R_binary, dtype=np.uint8),
+        np.ascontiguousarray(R_aff, dtype=np.float64),
+        config.REC_WIDTH,
+        config.REC_MIN_LEN,
+    )
+    # 同点の場合は offset, start_a の昇順
+    order = np.lexsort((start_a, offset, -length, -(score * length)))
+    start_a = start_a[order]
+    return MotifSegments(start_a, start_a + offset[order], length[order], score[order])
 
 
+@njit(cache=True)
 def _overlap_1d(a0: int, a1: int, b0: int, b1: int) -> bool:
     return not (a1 <= b0 or b1 <= a0)
 
 
-def _select_non_overlapping(segments: list[dict], top_k: int = 100) -> list[dict]:
-    """重複しないモチーフ区間を選択する。"""
-    selected: list[dict] = []
-    for seg in segments:
-        a0, a1 = seg["start_a"], seg["start_a"] + seg["length"]
-        b0, b1 = seg["start_b"], seg["start_b"] + seg["length"]
+@njit(cache=True)
+def _select_kernel(
+    start_a: np.ndarray,
+    start_b: np.ndarray,
+    length: np.ndarray,
+    top_k: int,
+) -> np.ndarray:
+    """重複しない区間を先頭から貪欲に選び、選択マスクを返す (Numba)。"""
+    n = start_a.shape[0]
+    mask = np.zeros(n, dtype=np.bool_)
+    # 選択済み区間 (SoA)
+    kept_a0 = np.empty(n, dtype=np.int64)
+    kept_b0 = np.empty(n, dtype=np.int64)
+    kept_len = np.empty(n, dtype=np.int64)
+    n_kept = 0
+
+    for idx in range(n):
+        a0, b0 = start_a[idx], start_b[idx]
+        a1, b1 = a0 + length[idx], b0 + length[idx]
 
         # A と B 自体が重なる場合は除外
         if _overlap_1d(a0, a1, b0, b1):
             continue
 
         ok = True
-        # すでにkeptに追加されたモチーフと重複する場合は除外
-        for kept in selected:
-            ka0 = kept["start_a"]
-            ka1 = ka0 + kept["length"]
-            kb0 = kept["start_b"]
-            kb1 = kb0 + kept["length"]
-            if _overlap_1d(a0, a1, ka0, ka1) and _overlap_1d(b0, b1, kb0, kb1):
+        # すでに選択されたモチーフと重複する場合は除外
+        for k in range(n_kept):
+            ka0, kb0 = kept_a0[k], kept_b0[k]
+            if (_overlap_1d(a0, a1, ka0, ka0 + kept_len[k])
+                    and _overlap_1d(b0, b1, kb0, kb0 + kept_len[k])):
                 ok = False
                 break
         if ok:
-            selected.append(seg)
+            mask[idx] = True
+            kept_a0[n_kept] = a0
+            kept_b0[n_kept] = b0
+            kept_len[n_kept] = length[idx]
+            n_kept += 1
         # k個選択したら終了
-        if len(selected) >= top_k:
+        if n_kept >= top_k:
             break
-    return selected
+    return mask
+
+
+def _select_non_overlapping(segments: MotifSegments, top_k: int = 100) -> MotifSegments:
+    """重複しないモチーフ区間を選択する。"""
+    mask = _select_kernel(segments.start_a, segments.start_b, segments.length, top_k)
+    return segments.take(mask)
+
+
+def _gaussian_weights(sigma: float, truncate: float = 4.0) -> np.ndarray:
+    """scipy.ndimage.gaussian_filter1d と同じ正規化済みガウス窓。"""
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1)
+    weights = np.exp(-0.5 / sigma**2 * x**2)
+    return weights / weights.sum()
+
+
+_PITCH_SMOOTH_WEIGHTS = _gaussian_weights(0.8)
+
+
+@njit(cache=True)
+def _smooth_profiles(x: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """ピッチ方向のガウス平滑化と時間方向の2点移動平均を1回の走査で行う (Numba)。
+
+    gaussian_filter1d(axis=1) → uniform_filter1d(size=2, axis=0) (いずれも mode="nearest") と等価。
+    """
+    T, P = x.shape
+    radius = weights.shape[0] // 2
+    out = np.empty_like(x)
+    prev = np.empty(P, dtype=np.float64)  # 1つ前の時刻のピッチ方向平滑化結果
+    cur = np.empty(P, dtype=np.float64)
+    for t in range(T):
+        for p in range(P):
+            acc = 0.0
+            for k in range(-radius, radius + 1):
+                q = min(max(p + k, 0), P - 1)
+                acc += weights[k + radius] * x[t, q]
+            cur[p] = acc
+        if t == 0:
+            prev[:] = cur
+        for p in range(P):
+            out[t, p] = 0.5 * (prev[p] + cur[p])
+        prev[:] = cur
+    return out
+
+
+def _recurrence_affinity(features: np.ndarray, width: int) -> np.ndarray:
+    """コサイン距離の相互 k 近傍に基づく再帰 (affinity) 行列を返す。
+
+    librosa.segment.recurrence_matrix(metric="cosine", mode="affinity", sym=True, k=None)
+    と同じ規則で、features が L2 正規化済み (またはゼロ行) であることを利用して
+    距離行列を1回の行列積で求める。
+    """
+    T = features.shape[0]
+    k = int(2 * np.ceil(np.sqrt(T - 2 * width + 1)))
+    n_neighbors = min(T - 1, k + 2 * width)
+
+    dist = features @ features.T
+    np.subtract(1.0, dist, out=dist)
+    np.clip(dist, 0.0, 2.0, out=dist)
+
+    # 自身を除く n_neighbors 近傍を候補とする
+    ranked = dist.copy()
+    np.fill_diagonal(ranked, np.inf)
+    candidates = np.argpartition(ranked, n_neighbors - 1, axis=1)[:, :n_neighbors]
+    is_candidate = np.zeros((T, T), dtype=bool)
+    np.put_along_axis(is_candidate, candidates, True, axis=1)
+
+    # width 未満の近接フレームと距離0のリンクを除き、近い順に k 個残す
+    lag = np.abs(np.arange(T)[:, np.newaxis] - np.arange(T)[np.newaxis, :])
+    is_candidate &= (lag >= width) & (dist > 0)
+    ranked[~is_candidate] = np.inf
+    n_keep = min(k, T)
+    nearest = np.argpartition(ranked, n_keep - 1, axis=1)[:, :n_keep]
+    links = np.zeros((T, T), dtype=bool)
+    np.put_along_axis(links, nearest, True, axis=1)
+    links &= is_candidate
+
+    # 相互近傍のみ残す (対称化)
+    links &= links.T
+    if not links.any():
+        return np.zeros_like(dist)
+
+    # バンド幅: 各フレームの k 番目に近いリンクまでの距離の中央値
+    link_dist = np.where(links, dist, np.inf)
+    link_dist.sort(axis=1)
+    n_links = links.sum(axis=1)
+    has_links = n_links > 0
+    kth = np.minimum(n_links, k) - 1
+    bandwidth = float(np.median(link_dist[has_links, kth[has_links]]))
+
+    return np.where(links, np.exp(-dist / bandwidth), 0.0).astype(dist.dtype)
+
+
+@njit(cache=True)
+def _diagonal_gaussian_filter(R: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """再帰行列の各対角線方向に1次元ガウシアンフィルタをかける (Numba)。
+
+    librosa.segment.timelag_filter(gaussian_filter1d)(R, mode="mirror") と等価。
+    ラグ l = i - j の対角線を列方向の系列 (範囲外の行は 0) とみなし、列の両端で折り返す。
+    """
+    T = R.shape[0]
+    radius = weights.shape[0] // 2
+    out = np.empty_like(R)
+    for i in range(T):
+        for j in range(T):
+            lag = i - j
+            acc = 0.0
+            for k in range(-radius, radius + 1):
+                c = j + k
+                if c < 0:
+                    c = -c
+                elif c >= T:
+                    c = 2 * (T - 1) - c
+                r = c + lag
+                if 0 <= r < T:
+                    acc += weights[k + radius] * R[r, c]
+            out[i, j] = acc
+    return out
+
+
+_DIAGONAL_SMOOTH_WEIGHTS = _gaussian_weights(1.2)
+
+
+@njit(cache=True)
+def _motif_correction_kernel(
+    notes: np.ndarray,
+    start_a: np.ndarray,
+    start_b: np.ndarray,
+    length: np.ndarray,
+    w_self: float,
+    w_motif: float,
+    out: np.ndarray,
+) -> None:
+    """対応区間どうしでノート確率を加算し、self / motif の重み付き和を out に書き込む (Numba)。
+
+    選択済み区間でも一方の区間が他の区間と行を共有しうるため、加算は区間順に逐次行う。
+    out は notes と同じ配列でもよい (加算がすべて終わってから書き込む)。
+    """
+    T, P = notes.shape
+    contributions = np.zeros_like(notes)
+    counts = np.zeros(T, dtype=np.int64)  # 正規化用のカウント
+
+    for s in range(start_a.shape[0]):
+        a0, b0 = start_a[s], start_b[s]
+        valid_len = min(length[s], T - a0, T - b0)
+        # 対応するモチーフ間でノートの確率を補完し合う
+        for i in range(valid_len):
+            for p in range(P):
+                contributions[a0 + i, p] += notes[b0 + i, p]
+                contributions[b0 + i, p] += notes[a0 + i, p]
+            counts[a0 + i] += 1
+            counts[b0 + i] += 1
+
+    # 重み付き和で補正 (モチーフに含まれないグリッドはそのまま)
+    for t in range(T):
+        if counts[t] == 0:
+            for p in range(P):
+                out[t, p] = notes[t, p]
+        else:
+            motif_weight = w_motif / counts[t]
+            for p in range(P):
+                out[t, p] = w_self * notes[t, p] + motif_weight * contributions[t, p]
+
+
+def _warmup() -> None:
+    """初回リクエストで JIT コンパイルが走らないよう、import 時にコンパイルしておく。"""
+    start_a, offset, length, _ = _scan_diagonals(
+        np.zeros((2, 2), dtype=np.uint8), np.zeros((2, 2)), 1, 1,
+    )
+    _select_kernel(start_a, start_a + offset, length, 1)
+    _smooth_profiles(np.zeros((2, 2), dtype=np.float32), _PITCH_SMOOTH_WEIGHTS)
+    notes = np.zeros((2, 2), dtype=np.float32)
+    _diagonal_gaussian_filter(notes, _DIAGONAL_SMOOTH_WEIGHTS)
+    _motif_correction_kernel(notes, start_a, start_a + offset, length, 0.6, 0.4, notes)
 
 
-def extract_motifs(biased_notes: np.ndarray) -> list[dict]:
+_warmup()
+
+
+def extract_motifs(biased_notes: np.ndarray) -> MotifSegments:
     """ノート確率からモチーフ区間を抽出する。
 
     Parameters
@@ -87,24 +352,21 @@ def extract_motifs(biased_notes: np.ndarray) -> list[dict]:
 
     Returns
     -------
-    motif_segments : モチーフ区間のリスト
+    motif_segments : モチーフ区間
     """
     # 歌唱音域に限定
     pitch_lo, pitch_hi = config.LOWEST_PITCH, config.HIGHEST_PITCH
     notes_in_range = np.array(
-        biased_notes[:, pitch_lo:pitch_hi + 1], dtype=np.float64, copy=True
+        biased_notes[:, pitch_lo:pitch_hi + 1], dtype=np.float32, copy=True
     )
     notes_in_range[notes_in_range < 0] = 0.0
 
     T, P = notes_in_range.shape
     if T < 2:
-        return []
-
-    profiles = notes_in_range.copy()
+        return MotifSegments.empty()
 
-    # 平滑化
-    profiles = gaussian_filter1d(profiles, sigma=0.8, axis=1, mode="nearest") # ピッチ方向
-    profiles = uniform_filter1d(profiles, size=2, axis=0, mode="nearest") # 時間方向
+    # 平滑化 (ピッチ方向: ガウシアン, 時間方向: 2点移動平均)
+    profiles = _smooth_profiles(notes_in_range, _PITCH_SMOOTH_WEIGHTS)
 
     # ノイズのフィルタリング
     peak_values = profiles.max(axis=1, keepdims=True)
@@ -121,18 +383,17 @@ def extract_motifs(biased_notes: np.ndarray) -> list[dict]:
     features = profiles / norms
 
     # 再帰行列
-    R = librosa.segment.recurrence_matrix(
-        features.T, k=None, width=config.REC_WIDTH,
-        metric="cosine", mode="affinity", sym=True, sparse=False,
-    )
+    if config.REC_WIDTH >= (T - 1) // 2:
+        return MotifSegments.empty()
+    R = _recurrence_affinity(features, config.REC_WIDTH)
     # 対角成分を強調
-    R_enhanced = librosa.segment.timelag_filter(gaussian_filter1d)(R, sigma=1.2, mode="mirror")
+    R_enhanced = _diagonal_gaussian_filter(R, _DIAGONAL_SMOOTH_WEIGHTS)
     np.fill_diagonal(R_enhanced, 0.0)
 
     # しきい値
     valid_vals = R_enhanced[R_enhanced > 0]
     if valid_vals.size == 0:
-        return []
+        return MotifSegments.empty()
     # 上位 REC_QUANTILE % の値をしきい値とする
     rec_threshold = np.percentile(valid_vals, config.REC_QUANTILE * 100)
     R_bin = (R_enhanced >= rec_threshold).astype(np.uint8)
@@ -143,37 +404,24 @@ def extract_motifs(biased_notes: np.ndarray) -> list[dict]:
 
 def apply_motif_correction(
     biased_notes: np.ndarray,
-    motif_segments: list[dict],
+    motif_segments: MotifSegments,
     w_self: float = 0.6,
     w_motif: float = 0.4,
+    out: np.ndarray | None = None,
 ) -> np.ndarray:
-    """モチーフ対応に基づいてノート確率を補正する。"""
-    n_grids = biased_notes.shape[0]
-    contributions = np.zeros_like(biased_notes)
-    counts = np.zeros(n_grids, dtype=np.float64) # 正規化用のカウント
-
-    for seg in motif_segments:
-        a0 = seg["start_a"]
-        b0 = seg["start_b"]
-        L = seg["length"]
-        valid_len = min(L, n_grids - a0, n_grids - b0)
-        if valid_len <= 0:
-            continue
-        
-        # 対応するモチーフ間でノートの確率を補完し合う
-        a_sl = slice(a0, a0 + valid_len)
-        b_sl = slice(b0, b0 + valid_len)
-
-        contributions[a_sl] += biased_notes[b_sl]
-        counts[a0:a0 + valid_len] += 1
-        contributions[b_sl] += biased_notes[a_sl]
-        counts[b0:b0 + valid_len] += 1
-
-    has_motif = counts > 0
-    corrected = biased_notes.copy()
-    if has_motif.any():
-        avg = contributions[has_motif] / counts[has_motif, np.newaxis]
-        # 重み付き和で補正
-        corrected[has_motif] = w_self * biased_notes[has_motif] + w_motif * avg
-
-    return corrected
+    """モチーフ対応に基づいてノート確率を補正する。
+
+    out を指定した場合は結果をそこに書き込む (biased_notes 自身も指定可)。
+    """
+    if out is None:
+        out = np.empty_like(biased_notes)
+    _motif_correction_kernel(
+        biased_notes,
+        motif_segments.start_a,
+        motif_segments.start_b,
+        motif_segments.length,
+        w_self,
+        w_motif,
+        out,
+    )
+    return out
@@ -6,80 +6,157 @@ from __future__ import annotations
 
 import numpy as np
 import pretty_midi
+from numba import njit
 
 from .. import config
 
+
+@njit(cache=True, fastmath=True)
+def _assign_kernel(
+    onsets: np.ndarray,
+    notes: np.ndarray,
+    times: np.ndarray,
+    onset_thr: float,
+    pitch_thr: float,
+    midi_offset: int,
+    assigned: np.ndarray,
+    out_pitch: np.ndarray,
+    out_start: np.ndarray,
+    out_end: np.ndarray,
+) -> int:
+    """グリーディ割り当ての本体 (Numba)。
+
+    確定したノートを out_pitch / out_start / out_end に書き込み、その個数を返す。
+    assigned は鳴っているグリッドの行を one-hot で上書きする。
+    """
+    num_grids, n_pitches = onsets.shape
+    n_events = 0
+
+    # 走査中のグリッドで鳴っている音 (-1: 無音) とその開始時刻
+    active_pitch = -1
+    active_start = 0.0
+
+    for i in range(num_grids):
+        # onset / pitch の argmax を1回の走査で求める
+        onset_idx = 0
+        onset_max = onsets[i, 0]
+        pitch_idx = 0
+        pitch_max = notes[i, 0]
+        for p in range(1, n_pitches):
+            if onsets[i, p] > onset_max:
+                onset_max = onsets[i, p]
+                onset_idx = p
+            if notes[i, p] > pitch_max:
+                pitch_max = notes[i, p]
+                pitch_idx = p
+
+        has_onset = onset_max >= onset_thr
+        detected_pitch = pitch_idx + midi_offset if pitch_max >= pitch_thr else -1
+        grid_time = times[i]
+
+        # 終了判定
+        if active_pitch >= 0:
+            if detected_pitch < 0 or detected_pitch != active_pitch or has_onset:
+                out_pitch[n_events] = active_pitch
+                out_start[n_events] = active_start
+                out_end[n_events] = grid_time
+                n_events += 1
+                active_pitch = -1
+
+        # 開始判定
+        if active_pitch < 0 and detected_pitch >= 0:
+            active_pitch = detected_pitch
+            active_start = grid_time
+
+        # 現在のグリッドで音が鳴っている場合，そのピッチを割り当て
+        if active_pitch >= 0:
+            for p in range(n_pitches):
+                assigned[i, p] = 0.0
+            assigned[i, active_pitch - midi_offset] = 1.0
+
+    # 末尾処理
+    if active_pitch >= 0:
+        end_time = times[num_grids - 1]
+        if num_grids > 1:
+            end_time += times[num_grids - 1] - times[num_grids - 2]
+        out_pitch[n_events] = active_pitch
+        out_start[n_events] = active_start
+        out_end[n_events] = end_time
+        n_events += 1
+
+    return n_events
+
+
 def greedy_note_assignment(
     grid_onsets: np.ndarray,
     grid_notes: np.ndarray,
     grid_times: np.ndarray,
     onset_threshold: float = 0.50,
     pitch_threshold: float = 0.45,
+    assigned_out: np.ndarray | None = None,
 ) -> tuple[np.ndarray, list[pretty_midi.Note]]:
-    """グリーディなノート割り当てを行い、割り当て済みピッチ配列と MIDI ノートを返す。"""
+    """グリーディなノート割り当てを行い、割り当て済みピッチ配列と MIDI ノートを返す。
+
+    assigned_out (float32, C 連続) を指定した場合は割り当て結果をそこに書き込む。
+    grid_notes 自身を指定してもよい。
+    """
     if grid_onsets.shape != grid_notes.shape:
         raise ValueError("grid_onsets and grid_notes must have the same shape")
     if grid_onsets.shape[0] != len(grid_times):
         raise ValueError("grid count and grid_times length must match")
 
     num_grids = grid_onsets.shape[0]
-    assigned = grid_notes.copy()
-    notes: list[pretty_midi.Note] = []
+    onsets = np.ascontiguousarray(grid_onsets, dtype=np.float32)
+    pitches = np.ascontiguousarray(grid_notes, dtype=np.float32)
+    times = np.ascontiguousarray(grid_times, dtype=np.float64)
+    if assigned_out is None:
+        assigned = np.array(pitches, copy=True)
+    else:
+        if (assigned_out.shape != pitches.shape or assigned_out.dtype != np.float32
+                or not assigned_out.flags.c_contiguous):
+            raise ValueError("assigned_out must be a C-contiguous float32 array shaped like grid_notes")
+        assigned = assigned_out
+        # 各行は読み込み後に上書きされるので、grid_notes と同じバッファでもよい
+        if not np.shares_memory(assigned, pitches):
+            np.copyto(assigned, pitches)
 
-    # 走査中のグリッドで鳴っている音
-    active_pitch: int | None = None
-    # 鳴っている音の開始時刻
-    active_start: float | None = None
+    # ノート数はグリッド数を超えない
+    out_pitch = np.empty(num_grids, dtype=np.int64)
+    out_start = np.empty(num_grids, dtype=np.float64)
+    out_end = np.empty(num_grids, dtype=np.float64)
+    n_events = _assign_kernel(
+        onsets, pitches, times,
+        float(onset_threshold), float(pitch_threshold), int(config.MIDI_OFFSET),
+        assigned, out_pitch, out_start, out_end,
+    )
 
-    for i in range(num_grids):
-        onset = grid_onsets[i]
-        pitch = grid_notes[i]
-        grid_time = float(grid_times[i])
+    notes = [
+        pretty_midi.Note(velocity=50, pitch=int(pitch), start=float(start), end=float(end))
+        for pitch, start, end in zip(
+            out_pitch[:n_events].tolist(),
+            out_start[:n_events].tolist(),
+            out_end[:n_events].tolist(),
+        )
+    ]
+    return assigned, notes
 
-        detected_onset = (int(np.argmax(onset)) + config.MIDI_OFFSET) if np.max(onset) >= onset_threshold else None
-        detected_pitch = (int(np.argmax(pitch)) + config.MIDI_OFFSET) if np.max(pitch) >= pitch_threshold else None
 
-        # 終了判定
-        if active_pitch is not None: # すでに音が鳴っている場合
-            should_close = (
-                detected_pitch is None
-                or detected_pitch != active_pitch
-                or detected_onset is not None
-            )
-            if should_close:
-                notes.append(pretty_midi.Note(
-                    velocity=50, pitch=int(active_pitch),
-                    start=active_start, end=grid_time,
-                ))
-                active_pitch = None
-                active_start = None
+def _warmup() -> None:
+    """初回リクエストで JIT コンパイルが走らないよう、import 時にコンパイルしておく。"""
+    dummy = np.zeros((2, 1), dtype=np.float32)
+    _assign_kernel(
+        dummy, dummy, np.zeros(2, dtype=np.float64), 0.5, 0.5, 0,
+        dummy.copy(), np.empty(2, dtype=np.int64),
+        np.empty(2, dtype=np.float64), np.empty(2, dtype=np.float64),
+    )
 
-        # 開始判定
-        if active_pitch is None and detected_pitch is not None:
-            active_pitch = detected_pitch
-            active_start = grid_time
 
-        # 現在のグリッドで音が鳴っている場合，そのピッチを割り当て
-        if active_pitch is not None:
-            assigned[i] = np.zeros_like(assigned[i])
-            assigned[i][active_pitch - config.MIDI_OFFSET] = 1.0
+_warmup()
 
-    # 末尾処理
-    if active_pitch is not None:
-        end_time = grid_times[-1] + (grid_times[-1] - grid_times[-2]) if num_grids > 1 else grid_times[-1]
-        notes.append(pretty_midi.Note(
-            velocity=50,
-            pitch=int(active_pitch),
-            start=active_start,
-            end=float(end_time)
-        ))
-
-    return assigned, notes
-    
 
 def note_list_to_midi(midi_notes: list[pretty_midi.Note]) -> pretty_midi.PrettyMIDI:
     pm = pretty_midi.PrettyMIDI()
     instrument = pretty_midi.Instrument(program=0)
     instrument.notes = midi_notes
     pm.instruments.append(instrument)
-    return pm
\ No newline at end of file
+    return pm
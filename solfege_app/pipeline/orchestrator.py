@@ -24,11 +24,9 @@ def run_full_pipeline(
     update_job(job_id, step="demucs", progress=0.1, message="Running Demucs separation")
     demucs_result: DemucsSeparationResult = separation.run_demucs()
 
+    # キー推定はドラムを除いた Demucs ステムで行う (元音源の再デコードと HPSS が不要)
     update_job(job_id, step="transcription", progress=0.75, message="Running transcription + solfege")
-    transcription = run_transcription(
-        demucs_result, artifacts_dir,
-        original_audio_path=input_path,
-    )
+    transcription = run_transcription(demucs_result, artifacts_dir)
 
     update_job(job_id, step="finalize", progress=0.95, message="Preparing result")
     return {
@@ -0,0 +1,86 @@
+"""basic-pitch 推論モジュール。
+
+basic_pitch.inference.predict はファイルパスしか受け付けないため、
+同じ窓分割・推論・ノート変換を NumPy 配列に対して直接行う。
+モデルはプロセスごとに1回だけ読み込んで使い回す。
+"""
+from __future__ import annotations
+
+from functools import lru_cache
+from threading import Lock
+
+import numpy as np
+import pretty_midi
+from basic_pitch import ICASSP_2022_MODEL_PATH
+from basic_pitch.constants import AUDIO_N_SAMPLES, AUDIO_SAMPLE_RATE, FFT_HOP
+from basic_pitch.inference import Model, unwrap_output, window_audio_file
+from basic_pitch.note_creation import model_output_to_notes
+
+# basic_pitch.inference.run_inference と同じ窓の重なり (フレーム数)
+N_OVERLAPPING_FRAMES = 30
+
+# 1つのモデル (推論コンテキスト) を複数スレッドから同時に使わないようにする
+_model_lock = Lock()
+
+
+@lru_cache(maxsize=None)
+def load_model() -> Model:
+    """basic-pitch のモデル (読み込みとグラフ構築を伴う) を使い回す。"""
+    return Model(ICASSP_2022_MODEL_PATH)
+
+
+def _run_inference(y: np.ndarray, model: Model) -> dict[str, np.ndarray]:
+    """basic_pitch.inference.run_inference と同じ処理をファイルを介さずに行う。"""
+    overlap_len = N_OVERLAPPING_FRAMES * FFT_HOP
+    hop_size = AUDIO_N_SAMPLES - overlap_len
+    audio = np.concatenate(
+        [np.zeros(overlap_len // 2, dtype=np.float32), y.astype(np.float32, copy=False)]
+    )
+
+    output: dict[str, list[np.ndarray]] = {"note": [], "onset": [], "contour": []}
+    with _model_lock:
+        for window, _ in window_audio_file(audio, hop_size):
+            for k, v in model.predict(window[np.newaxis]).items():
+                output[k].append(v)
+    return {
+        k: unwrap_output(np.concatenate(v), y.shape[0], N_OVERLAPPING_FRAMES)
+        for k, v in output.items()
+    }
+
+
+def predict_array(
+    y: np.ndarray,
+    onset_threshold: float = 0.5,
+    frame_threshold: float = 0.3,
+    minimum_note_length: float = 127.70,
+    minimum_frequency: float | None = None,
+    maximum_frequency: float | None = None,
+    multiple_pitch_bends: bool = False,
+    melodia_trick: bool = True,
+    midi_tempo: float = 120,
+) -> tuple[dict[str, np.ndarray], pretty_midi.PrettyMIDI]:
+    """basic_pitch.inference.predict の配列版。
+
+    Parameters
+    ----------
+    y : basic-pitch のサンプリングレート (AUDIO_SAMPLE_RATE) のモノラル信号
+    その他の引数は predict と同じ (minimum_note_length はミリ秒)
+
+    Returns
+    -------
+    (model_output, midi_data)
+    """
+    model_output = _run_inference(y, load_model())
+    min_note_len = int(np.round(minimum_note_length / 1000 * (AUDIO_SAMPLE_RATE / FFT_HOP)))
+    midi_data, _ = model_output_to_notes(
+        model_output,
+        onset_thresh=onset_threshold,
+        frame_thresh=frame_threshold,
+        min_note_len=min_note_len,
+        min_freq=minimum_frequency,
+        max_freq=maximum_frequency,
+        multiple_pitch_bends=multiple_pitch_bends,
+        melodia_trick=melodia_trick,
+        midi_tempo=midi_tempo,
+    )
+    return model_output, midi_data
@@ -1,21 +1,20 @@
 from __future__ import annotations
 
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
+from functools import lru_cache
+import gc
+import multiprocessing
 from pathlib import Path
-from typing import Iterable
+from threading import Lock
+from typing import Any
 
+import torch
 from demucs.separate import main as demucs_separator
 from audio_separator.separator import Separator
 
-def _find_first(paths: Iterable[Path], predicate) -> Path | None:
-    """
-    パスのリストから，条件に合致する最初のファイルを見つけて返す．
-    条件に合致するファイルがない場合は None を返す．
-    """
-    for path in paths:
-        if predicate(path):
-            return path
-    return None
+from .. import config
+
 
 @dataclass
 class DemucsSeparationResult:
@@ -32,22 +31,19 @@ def run_separation_by_demucs(input_audio: Path, output_root: Path) -> DemucsSepa
     args = ["-o", str(output_root), "-n", "htdemucs", "--mp3", str(input_audio)]
     # コマンドライン引数を指定して実行
     demucs_separator(args)
-    # Demucsの出力先ディレクトリ下の，ファイル名以下のパスを探索する
-    # output_root/htdemucs/{input_audio_stem}/vocals.mp3 などを想定
-    audio_stem = input_audio.stem
-    
-    # 各ステムのファイルを探索
+    # Demucsの出力先は output_root/htdemucs/{input_audio_stem}/vocals.mp3 に決まっているので，
+    # ディレクトリを探索せずにパスを組み立てる
+    stem_dir = output_root / "htdemucs" / input_audio.stem
+
     stems = {}
     for stem_name in ["vocals", "drums", "bass", "other"]:
-        candidates = list(output_root.rglob(f"{stem_name}.mp3")) + list(output_root.rglob(f"{stem_name}.wav"))
-        exact = _find_first(candidates, lambda p: audio_stem in str(p.parent))
-        if exact:
-            stems[stem_name] = exact
-        elif candidates:
-            stems[stem_name] = candidates[0]
-        else:
-            raise FileNotFoundError(f"demucs {stem_name} output not found")
-    
+        path = stem_dir / f"{stem_name}.mp3"
+        if not path.is_file():
+            path = stem_dir / f"{stem_name}.wav"
+        if not path.is_file():
+            raise FileNotFoundError(f"demucs {stem_name} output not found: {stem_dir}")
+        stems[stem_name] = path
+
     return DemucsSeparationResult(
         vocals=stems["vocals"],
         drums=stems["drums"],
@@ -70,6 +66,61 @@ def _as_path_list(outputs: list[str], cwd: Path) -> list[Path]:
     return result
 
 
+INSTRUMENTAL_MODEL = "UVR_MDXNET_KARA.onnx"
+DEREVERB_MODEL = "UVR-DeEcho-DeReverb.pth"
+
+# キャッシュした Separator は出力先とモデルを書き換えて使うため，同時に1つの分離だけを許可する
+_separator_lock = Lock()
+
+
+@lru_cache(maxsize=4)
+def _cached_separator(
+    mdx_items: tuple[tuple[str, Any], ...], vr_items: tuple[tuple[str, Any], ...]
+) -> Separator:
+    """推論パラメータごとに Separator (推論デバイスの初期化を伴う) を使い回す．"""
+    return Separator(mdx_params=dict(mdx_items), vr_params=dict(vr_items))
+
+
+def _release_model(separator: Separator) -> None:
+    """前回読み込んだモデルを解放し，GPU メモリを返却する．"""
+    if getattr(separator, "model_instance", None) is None:
+        return
+    separator.model_instance = None
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def _separate_with_model(
+    model_filename: str,
+    audio_path: Path,
+    output_dir: Path,
+    mdx_params: dict[str, Any],
+    vr_params: dict[str, Any],
+) -> list[Path]:
+    """キャッシュした Separator に model_filename の重みを読み込んで分離し，出力パスを返す．"""
+    with _separator_lock:
+        separator = _cached_separator(
+            tuple(sorted(mdx_params.items())), tuple(sorted(vr_params.items()))
+        )
+        _release_model(separator)
+        # output_dir は load_model 時にモデルへ渡される
+        separator.output_dir = str(output_dir)
+        separator.load_model(model_filename)
+        outputs = separator.separate(str(audio_path))
+    return _as_path_list(outputs, output_dir)
+
+
+def _limit_cuda_memory(fraction: float) -> None:
+    """ワーカープロセスの PyTorch (CUDA キャッシュアロケータ) が使う GPU メモリに上限を設定する．
+
+    制限されるのは torch 経由の確保 (Demucs など) だけで，UVR MDX モデルを動かす
+    onnxruntime の CUDA メモリはこの上限の対象外．
+    """
+    if torch.cuda.is_available():
+        torch.cuda.set_per_process_memory_fraction(fraction)
+
+
 
 @dataclass
 class SeparationArtifacts:
@@ -84,11 +135,23 @@ class SeparationArtifacts:
 
 
 class AudioSeparationPipeline:
-    """音声分離処理と関連パスを一元管理するクラス。"""
+    """音声分離処理と関連パスを一元管理するクラス。
+
+    mdx_params / vr_params は UVR (audio-separator) の推論パラメータで，
+    省略時は config.UVR_MDX_PARAMS / config.UVR_VR_PARAMS を使う。
+    """
 
-    def __init__(self, input_audio: Path, job_dir: Path) -> None:
+    def __init__(
+        self,
+        input_audio: Path,
+        job_dir: Path,
+        mdx_params: dict[str, Any] | None = None,
+        vr_params: dict[str, Any] | None = None,
+    ) -> None:
         self.input_audio = Path(input_audio)
         self.job_dir = Path(job_dir)
+        self.mdx_params = {**config.UVR_MDX_PARAMS, **(mdx_params or {})}
+        self.vr_params = {**config.UVR_VR_PARAMS, **(vr_params or {})}
 
         self.processed_dir = self.job_dir / "processed"
         self.demucs_dir = self.processed_dir / "htdemucs"
@@ -120,21 +183,25 @@ class AudioSeparationPipeline:
         Demucsによる音源分離（vocals, drums, bass, other）
         """
         result = run_separation_by_demucs(self.input_audio, self.demucs_dir)
+        self._set_demucs_result(result)
+        return result
+
+    def _set_demucs_result(self, result: DemucsSeparationResult) -> None:
         self.demucs_vocals = result.vocals
         self.demucs_drums = result.drums
         self.demucs_bass = result.bass
         self.demucs_other = result.other
-        return result
 
     def run_instrumental_separation(self) -> tuple[Path, Path]:
         """
         UVRを用いてインスト音源とボーカルの分離を行う．
         """
-        separator = Separator(output_dir=str(self.uvr_work_dir))
-        separator.load_model("UVR_MDXNET_KARA.onnx")
-        outputs = separator.separate(str(self.input_audio))
-        output_paths = _as_path_list(outputs, self.uvr_work_dir)
-        
+        output_paths = _separate_with_model(
+            INSTRUMENTAL_MODEL, self.input_audio, self.uvr_work_dir, self.mdx_params, self.vr_params
+        )
+        return self._set_instrumental_outputs(output_paths)
+
+    def _set_instrumental_outputs(self, output_paths: list[Path]) -> tuple[Path, Path]:
         print(f"DEBUG: UVR_MDXNET_KARA outputs: {[str(p) for p in output_paths]}")
 
         self.uvr_instrumental = self._pick_uvr_output(output_paths, "instrumental")
@@ -149,19 +216,31 @@ class AudioSeparationPipeline:
         if target_vocals is None:
             raise ValueError("demucs_vocals is not set. Run run_demucs() first or pass vocals_path.")
 
-        separator = Separator(output_dir=str(self.uvr_work_dir))
-        separator.load_model("UVR-DeEcho-DeReverb.pth")
-        outputs = separator.separate(str(target_vocals))
-        output_paths = _as_path_list(outputs, self.uvr_work_dir)
-        
+        output_paths = _separate_with_model(
+            DEREVERB_MODEL, target_vocals, self.uvr_work_dir, self.mdx_params, self.vr_params
+        )
+
         print(f"DEBUG: UVR-DeEcho-DeReverb outputs: {[str(p) for p in output_paths]}")
 
         self.dereverb_vocal = self._pick_uvr_output(output_paths, "no reverb")
         return self.dereverb_vocal
 
     def run_all(self) -> SeparationArtifacts:
-        self.run_demucs()
-        self.run_instrumental_separation()
+        # Demucs と UVR インスト分離は互いに独立なので別プロセスで並行実行し，
+        # demucs_vocals を使うエコー・リバーブ除去はその後に行う．
+        # GPU メモリの上限は torch 側 (Demucs) にしか効かず，UVR MDX (onnxruntime) は制限されないため，
+        # 両方を1枚の GPU に載せる場合は onnxruntime 側の使用量も含めて空きがあることが前提となる
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(
+            max_workers=2, mp_context=ctx, initializer=_limit_cuda_memory, initargs=(0.45,)
+        ) as executor:
+            demucs_future = executor.submit(run_separation_by_demucs, self.input_audio, self.demucs_dir)
+            uvr_future = executor.submit(
+                _separate_with_model,
+                INSTRUMENTAL_MODEL, self.input_audio, self.uvr_work_dir, self.mdx_params, self.vr_params,
+            )
+            self._set_demucs_result(demucs_future.result())
+            self._set_instrumental_outputs(uvr_future.result())
         self.run_echo_and_reverb_removal()
 
         if (self.demucs_vocals is None or self.demucs_drums is None or 
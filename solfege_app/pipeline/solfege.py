@@ -3,6 +3,7 @@ from __future__ import annotations
 from dataclasses import dataclass
 
 import numpy as np
+from numba import njit
 
 from .. import config
 
@@ -12,6 +13,17 @@ MINOR_PROFILE = [6.33, 2.68, 3.52, 5.38, 2.6, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34
 
 MOVABLE_DO_JA_SHARP = ["ド", "ド#", "レ", "レ#", "ミ", "ファ", "ファ#", "ソ", "ソ#", "ラ", "ラ#", "シ"]
 
+# キーインデックス (0–23) ごとのルックアップテーブル
+# ソルフェージュ用ルート: マイナーキーは平行長調のルート (短3度上)
+_SOLFEGE_ROOT_LUT = np.array(
+    [(k % 12 + (3 if k >= 12 else 0)) % 12 for k in range(24)], dtype=np.int8
+)
+_SOLFEGE_ROOT_TUPLE = tuple(_SOLFEGE_ROOT_LUT.tolist())
+KEY_LABELS = tuple(config.FULL_KEY_LABELS)
+# キーインデックスの配列からラベルを添字参照でまとめて引くためのテーブル (.tolist() で str が得られる)
+KEY_LABEL_ARRAY = np.array(KEY_LABELS, dtype=object)
+KEY_LABEL_ARRAY.setflags(write=False)
+
 
 def key_index_to_root_pc(key_index: int) -> int:
     """キーインデックス (0–23) から root pitch class (0–11) を返す。"""
@@ -31,15 +43,12 @@ def key_index_to_solfege_root(key_index: int) -> int:
     例: A minor (root=9) → C major (root=0)
         F minor (root=5) → Ab major (root=8)
     """
-    root_pc = key_index % 12
-    if key_index >= 12:  # minor
-        return (root_pc + 3) % 12
-    return root_pc
+    return _SOLFEGE_ROOT_TUPLE[key_index]
 
 
 def key_index_to_label(key_index: int) -> str:
     """キーインデックス (0–23) からキーラベル文字列を返す。"""
-    return config.FULL_KEY_LABELS[key_index]
+    return KEY_LABELS[key_index]
 
 
 def pitch_to_movable_do(pitch: int, key_root_pc: int) -> str:
@@ -57,6 +66,75 @@ def _find_grid_index(note_start: float, grid_times: np.ndarray) -> int:
     return max(0, min(idx, len(grid_times) - 1))
 
 
+# ベクトル化したラベル付け用のルックアップテーブル
+_MOVABLE_DO_LABELS = np.array(MOVABLE_DO_JA_SHARP)
+
+
+@njit(cache=True)
+def _label_indices(
+    starts: np.ndarray,
+    pitches: np.ndarray,
+    key_sequence: np.ndarray,
+    grid_times: np.ndarray,
+    root_lut: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """各ノートの移動ドのインデックス (0–11) とキーインデックスを1パスで求める (Numba)。
+
+    グリッドの対応付けは _find_grid_index、音程は pitch_to_movable_do と同じ規則。
+    """
+    n = starts.shape[0]
+    last = grid_times.shape[0] - 1
+    grid_idx = np.searchsorted(grid_times, starts, side="right")
+    intervals = np.empty(n, dtype=np.int64)
+    key_idx = np.empty(n, dtype=np.int64)
+    for i in range(n):
+        g = min(max(grid_idx[i] - 1, 0), last)
+        k = key_sequence[g]
+        key_idx[i] = k
+        intervals[i] = (pitches[i] % 12 - root_lut[k]) % 12
+    return intervals, key_idx
+
+
+def _warmup() -> None:
+    """初回リクエストで JIT コンパイルが走らないよう、import 時にコンパイルしておく。"""
+    _label_indices(
+        np.zeros(2), np.zeros(2, dtype=np.int64), np.zeros(2, dtype=np.int64),
+        np.zeros(2), _SOLFEGE_ROOT_LUT,
+    )
+
+
+_warmup()
+
+
+def label_notes(
+    starts: np.ndarray,
+    pitches: np.ndarray,
+    key_sequence: np.ndarray,
+    grid_times: np.ndarray,
+) -> tuple[list[str], list[str]]:
+    """各ノートのソルフェージュラベルとキーラベルをまとめて求める。
+
+    Parameters
+    ----------
+    starts : (num_notes,) ノートの開始時間（秒）。
+    pitches : (num_notes,) ノートの MIDI ピッチ。
+    key_sequence : (num_grids,) 各グリッドのキーインデックス (0–23)。
+    grid_times : (num_grids,) 各グリッドの開始時間（秒）。
+
+    Returns
+    -------
+    (solfege_labels, key_labels)
+    """
+    interval, key_idx = _label_indices(
+        np.ascontiguousarray(starts, dtype=np.float64),
+        np.ascontiguousarray(pitches, dtype=np.int64),
+        np.ascontiguousarray(key_sequence, dtype=np.int64),
+        np.ascontiguousarray(grid_times, dtype=np.float64),
+        _SOLFEGE_ROOT_LUT,
+    )
+    return _MOVABLE_DO_LABELS[interval].tolist(), KEY_LABEL_ARRAY[key_idx].tolist()
+
+
 def attach_solfege(
     note_events: list[dict],
     key_sequence: np.ndarray,
@@ -64,6 +142,8 @@ def attach_solfege(
 ) -> list[dict]:
     """ノートイベントにソルフェージュラベルを付与する（グリッドごとのキーを使用）。
 
+    note_events の各 dict に "solfege" と "key" を直接書き込む (コピーは作らない)。
+
     Parameters
     ----------
     note_events : ノートイベントのリスト。各要素は start, end, pitch, velocity を含む。
@@ -72,15 +152,16 @@ def attach_solfege(
 
     Returns
     -------
-    ソルフェージュラベルとキー情報を追加したノートイベントのリスト。
+    ソルフェージュラベルとキー情報を追加した note_events (同じリスト)。
     """
-    out = []
-    for ev in note_events:
-        copied = dict(ev)
-        grid_idx = _find_grid_index(ev["start"], grid_times)
-        key_idx = int(key_sequence[grid_idx])
-        root_pc = key_index_to_solfege_root(key_idx)
-        copied["solfege"] = pitch_to_movable_do(int(ev["pitch"]), root_pc)
-        copied["key"] = key_index_to_label(key_idx)
-        out.append(copied)
-    return out
+    n = len(note_events)
+    if n == 0:
+        return note_events
+    starts = np.fromiter((ev["start"] for ev in note_events), dtype=np.float64, count=n)
+    pitches = np.fromiter((ev["pitch"] for ev in note_events), dtype=np.int64, count=n)
+    solfege_labels, key_labels = label_notes(starts, pitches, key_sequence, grid_times)
+
+    for ev, solfege, key in zip(note_events, solfege_labels, key_labels):
+        ev["solfege"] = solfege
+        ev["key"] = key
+    return note_events
@@ -16,22 +16,24 @@
 """
 from __future__ import annotations
 
-import json
+from concurrent.futures import ThreadPoolExecutor
 import logging
+from operator import attrgetter
 from pathlib import Path
 
 import pretty_midi
 import librosa
 import numpy as np
+import orjson
 import soundfile as sf
-from basic_pitch import ICASSP_2022_MODEL_PATH
-from basic_pitch.inference import predict
+import soxr
 
 from .beat_grid import (
     detect_beats,
     quantize_to_grid,
     center_weighted_agg_func
 )
+from .hpss import extract_harmonic
 from .key_estimation import (
     KeyEstimate,
     apply_scale_bias,
@@ -42,13 +44,66 @@ from .note_assignment import (
     greedy_note_assignment,
     note_list_to_midi
 )
+from .pitch_inference import predict_array
 from .separation import DemucsSeparationResult
-from .solfege import attach_solfege
+from .solfege import KEY_LABEL_ARRAY, label_notes
 from .. import config
 
 logger = logging.getLogger(__name__)
 
 
+def _resample(y: np.ndarray, orig_sr: float, target_sr: float) -> np.ndarray:
+    """librosa.resample (res_type="soxr_hq") と同じ結果を soxr の1回の呼び出しで得る。
+
+    soxr は入力の dtype を保つので、float32 に揃えてから渡す。
+    """
+    y = np.asarray(y, dtype=np.float32)
+    if orig_sr == target_sr:
+        return y
+    n_samples = int(np.ceil(y.shape[-1] * float(target_sr) / orig_sr))
+    y_hat = soxr.resample(y, orig_sr, target_sr, quality="HQ")
+    return librosa.util.fix_length(y_hat, size=n_samples)
+
+
+def _read_mono(path: Path) -> tuple[np.ndarray, int]:
+    """音声ファイルを元のサンプリングレートのまま float32 モノラルで読み込む。
+
+    soundfile で直接デコードし、読めない形式のみ librosa.load にフォールバックする。
+    """
+    try:
+        y, file_sr = sf.read(str(path), dtype="float32", always_2d=True)
+    except sf.LibsndfileError:
+        y, file_sr = librosa.load(str(path), sr=None, dtype=np.float32)
+        return y, file_sr
+    y = y[:, 0] if y.shape[1] == 1 else y.mean(axis=1)
+    return y, file_sr
+
+
+def _load_stem(path: Path) -> np.ndarray:
+    """ステムを float32 モノラル (config.SAMPLE_RATE) で読み込む。"""
+    y, file_sr = _read_mono(path)
+    return _resample(y, file_sr, config.SAMPLE_RATE)
+
+
+def _mix_with_inst(y_inst: np.ndarray, y_transcribed: np.ndarray, gain: float = 0.5) -> np.ndarray:
+    """インスト音源に合成音を gain 倍して1つのバッファ上で加算し、ピークが 1 を超えれば正規化する。"""
+    mix_audio = np.zeros(max(len(y_inst), len(y_transcribed)), dtype=np.float32)
+    mix_audio[:len(y_inst)] = y_inst
+    # pretty_midi の合成音は float64 なので，加算前に float32 に揃える
+    y_transcribed = y_transcribed.astype(np.float32)
+    y_transcribed *= np.float32(gain)
+    mix_audio[:len(y_transcribed)] += y_transcribed
+    peak = max(mix_audio.max(), -mix_audio.min())
+    if peak > 1.0:
+        mix_audio /= peak
+    return mix_audio
+
+
+def _write_json(path: Path, obj: dict) -> None:
+    """obj を UTF-8・インデント幅2の JSON ファイルとして書き出す。"""
+    path.write_bytes(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+
+
 def run_transcription(
     demucs_result: DemucsSeparationResult,
     artifacts_dir: Path,
@@ -61,23 +116,35 @@ def run_transcription(
     vocal_no_reverb_path : リバーブ除去済みボーカル
     instrumental_path : UVR 分離済みインストゥルメンタル
     artifacts_dir : 成果物の保存先ディレクトリ
-    original_audio_path : 元の音源 (キー推定用、省略時は instrumental を使用)
+    original_audio_path : 元の音源 (キー推定用、省略時はドラム以外の Demucs ステムを HPSS なしで使用)
     """
     artifacts_dir.mkdir(parents=True, exist_ok=True)
     # --- 0. Demucsによる分離結果を読み込み ---
-    y_vocals_raw, sr = librosa.load(str(demucs_result.vocals))
-    if sr != config.SAMPLE_RATE:
-        raise ValueError(f"Sample rate of vocals is {sr}, expected {config.SAMPLE_RATE}")
-    y_bass_raw, _ = librosa.load(str(demucs_result.bass))
-    y_drums_raw, _ = librosa.load(str(demucs_result.drums))
-    y_other_raw, _ = librosa.load(str(demucs_result.other))
+    # デコードとリサンプリングは GIL を解放するので4ステムを並行して読み込む
+    sr = config.SAMPLE_RATE
+    stem_paths = [demucs_result.vocals, demucs_result.bass, demucs_result.drums, demucs_result.other]
+    with ThreadPoolExecutor(max_workers=len(stem_paths)) as executor:
+        y_vocals_raw, y_bass_raw, y_drums_raw, y_other_raw = executor.map(_load_stem, stem_paths)
     # インスト音源の合成
-    min_len = min(len(y_vocals_raw), len(y_bass_raw), len(y_drums_raw), len(y_other_raw))
-    y_vocals_raw = y_vocals_raw[:min_len]
-    y_bass_raw = y_bass_raw[:min_len]
-    y_drums_raw = y_drums_raw[:min_len]
-    y_other_raw = y_other_raw[:min_len]
-    y_inst_raw = y_bass_raw + y_drums_raw + y_other_raw
+    # Demucs の4ステムは同じ入力から作られるので通常は同じ長さ。異なる場合のみ短い方に揃える
+    stem_lens = {len(y_vocals_raw), len(y_bass_raw), len(y_drums_raw), len(y_other_raw)}
+    if len(stem_lens) > 1:
+        min_len = min(stem_lens)
+        logger.warning(f"  stem lengths differ {sorted(stem_lens)}; trimming to {min_len}")
+        y_vocals_raw = y_vocals_raw[:min_len]
+        y_bass_raw = y_bass_raw[:min_len]
+        y_drums_raw = y_drums_raw[:min_len]
+        y_other_raw = y_other_raw[:min_len]
+    # 元音源がない場合のキー推定用: ドラムを除いたステムの和 (打楽器成分は Demucs で分離済み)
+    use_stems_for_key = original_audio_path is None
+    y_tonal_raw = None
+    if use_stems_for_key:
+        y_tonal_raw = np.add(y_vocals_raw, y_bass_raw)
+        y_tonal_raw += y_other_raw
+    # インスト音源は bass のバッファに直接加算して一時配列を作らない
+    y_inst_raw = y_bass_raw
+    y_inst_raw += y_drums_raw
+    y_inst_raw += y_other_raw
     del y_bass_raw, y_drums_raw, y_other_raw
 
     # ── 1. チューニング補正 ──
@@ -87,18 +154,16 @@ def run_transcription(
     # チューニング補正: orig_sr * tuning_rate でリサンプリングすることで、
     # 実質的に再生速度を tuning_rate 倍にする（サンプリングレートは sr のまま）
     adjusted_sr = sr * tuning_rate
-    y_inst = librosa.resample(y_inst_raw, orig_sr=adjusted_sr, target_sr=sr)
-    y_vocals = librosa.resample(y_vocals_raw, orig_sr=adjusted_sr, target_sr=sr)
+    y_inst = _resample(y_inst_raw, adjusted_sr, sr)
+    y_vocals = _resample(y_vocals_raw, adjusted_sr, sr)
     logger.info(f"  tuning_offset={tuning_offset:.3f}, tuning_rate={tuning_rate:.4f}, sr={sr}")
     # キー推定後に不要になった変数を削除
     del y_inst_raw, y_vocals_raw
 
     # ── 2. ボーカル HPSS ──
     logger.info("Step 2: HPSS on vocals")
-    y_harmonic, _ = librosa.effects.hpss(y_vocals, margin=1.0)
-    harmonic_path = artifacts_dir / "vocals_harmonic.wav"
-    sf.write(str(harmonic_path), y_harmonic, sr)
-    del y_vocals, y_harmonic
+    y_harmonic = extract_harmonic(y_vocals, margin=1.0)
+    del y_vocals
 
     # ── 3. テンポ・ビート検出 ──
     logger.info("Step 3: Beat detection")
@@ -108,9 +173,9 @@ def run_transcription(
 
     # ── 4. basic-pitch 推論 ──
     logger.info("Step 4: basic-pitch inference")
-    model_output, basic_pitch_midi, _ = predict(
-        str(harmonic_path),
-        model_or_model_path=ICASSP_2022_MODEL_PATH,
+    # ハーモニック成分はファイルを介さずに配列のまま渡す
+    model_output, basic_pitch_midi = predict_array(
+        y_harmonic,
         onset_threshold=0.5,
         frame_threshold=0.3,
         minimum_note_length=20,
@@ -119,6 +184,7 @@ def run_transcription(
         melodia_trick=True,
         midi_tempo=midi_tempo,
     )
+    del y_harmonic
     onsets_np = model_output['onset']  # shape: (num_frames, num_pitches)
     pitches_np = model_output['note']  # shape: (num_frames, num_pitches)
     # basic_pitchのframeの実測SPFを計算
@@ -131,11 +197,11 @@ def run_transcription(
         # MIDIの最後のノートから実測SPFを逆算
         last_note = notes_basic[-1]
         last_pitch_idx = last_note.pitch - config.MIDI_OFFSET
-        # 最後のノートの音高を持つフレームを取得
-        last_frames = np.where(onsets_np[:, last_pitch_idx] > 0.5)[0]
-        
-        if len(last_frames) > 0:
-            last_frame = last_frames[-1]
+        # 最後のノートの音高で onset が立っている最後のフレームを取得
+        last_frames = np.flatnonzero(onsets_np[:, last_pitch_idx] > 0.5)
+
+        if last_frames.size > 0:
+            last_frame = int(last_frames[-1])
             # frameとMIDI時間の対応よりsecond per frameを計算
             spf_actual = last_note.start / last_frame
             logger.info(f"  Auto-calibrated SPF: {spf_actual:.10f} s/frame")
@@ -162,23 +228,31 @@ def run_transcription(
 
     # ── 6. キー推定 ──
     logger.info("Step 6: Key estimation")
-    y_for_key = y_inst
-    if original_audio_path is not None:
-        y_for_key, _ = librosa.load(str(original_audio_path), sr=sr)
-        y_for_key = librosa.resample(y_for_key, orig_sr=adjusted_sr, target_sr=sr)
+    if use_stems_for_key:
+        y_for_key = _resample(y_tonal_raw, adjusted_sr, sr)
+        del y_tonal_raw
+    else:
+        # 元のサンプリングレートから sr への変換とチューニング補正を1回のリサンプリングで行う
+        y_raw, raw_sr = _read_mono(original_audio_path)
+        y_for_key = _resample(y_raw, raw_sr * tuning_rate, sr)
+        del y_raw
     key_sequence, global_key = estimate_key_sequence(
-        y_for_key, sr, spf, beat_times_sec, block_size=config.SUBDIVISIONS
+        y_for_key, sr, spf, beat_times_sec, block_size=config.SUBDIVISIONS,
+        skip_hpss=use_stems_for_key,
     )
     logger.info(f"  global_key={global_key.label}")
 
     # ── 7. スケールバイアス適用 ──
     logger.info("Step 7: Scale bias")
-    biased_notes, biased_onsets = apply_scale_bias(grid_notes_np, grid_onsets_np, key_sequence)
+    # 以降の補正・割り当ては同じバッファを書き換えていく
+    biased_notes, biased_onsets = apply_scale_bias(
+        grid_notes_np, grid_onsets_np, key_sequence, inplace=True
+    )
 
     # ── 8. モチーフ抽出・補正 ──
     logger.info("Step 8: Motif extraction & correction")
     motif_segments = extract_motifs(biased_notes)
-    biased_notes = apply_motif_correction(biased_notes, motif_segments)
+    biased_notes = apply_motif_correction(biased_notes, motif_segments, out=biased_notes)
     logger.info(f"  motifs={len(motif_segments)}")
 
     # ── 9. グリーディノート割り当て (スケールバイアス + モチーフ補正済み) ──
@@ -188,6 +262,7 @@ def run_transcription(
         biased_notes, 
         grid_times_np, 
         pitch_threshold=0.40,
+        assigned_out=biased_notes,
     )
 
     # ── 10. MIDI 保存 + 伴奏ミックス ──
@@ -196,53 +271,52 @@ def run_transcription(
     midi_path = artifacts_dir / "vocals_transcribed.mid"
     pm.write(str(midi_path))
 
-    y_transcribed = pm.synthesize(fs=int(sr)).astype(np.float32)
-    mix_len = max(len(y_inst), len(y_transcribed))
-    y_inst_pad = np.pad(y_inst.astype(np.float32), (0, mix_len - len(y_inst)))
-    y_transcribed_pad = np.pad(y_transcribed, (0, mix_len - len(y_transcribed)))
+    # 合成音の生成は Step 11 と独立なので、バックグラウンドのスレッドで並行して行う
+    with ThreadPoolExecutor(max_workers=1) as background:
+        synth_future = background.submit(pm.synthesize, fs=int(sr))
 
-    mix_audio = y_inst_pad + 0.5 * y_transcribed_pad
-    peak = np.max(np.abs(mix_audio))
-    if peak > 1.0:
-        mix_audio = mix_audio / peak
-
-    mix_path = artifacts_dir / "vocals_transcribed_with_inst.wav"
-    sf.write(str(mix_path), mix_audio, sr)
-
-    # ── 11. ソルフェージュ生成 ──
-    logger.info("Step 11: Solfege generation")
-    # Create note_events from pretty_midi.Note objects
-    note_events: list[dict] = []
-    for note in sorted(notes, key=lambda n: (n.start, n.pitch)):
-        note_events.append({
-            "start": float(note.start),
-            "end": float(note.end),
-            "pitch": int(note.pitch),
-            "velocity": int(note.velocity),
-        })
-    note_events_with_solfege = attach_solfege(note_events, key_sequence, grid_times_np)
-
-    # key_sequence 情報をリストに変換（JSON シリアライズ用）
-    from .solfege import key_index_to_label
-    key_sequence_info = [
-        {"grid_time": float(t), "key": key_index_to_label(int(k))}
-        for t, k in zip(grid_times_np, key_sequence)
-    ]
-
-    solfege_json_path = artifacts_dir / "solfege.json"
-    with solfege_json_path.open("w", encoding="utf-8") as f:
-        json.dump(
+        # ── 11. ソルフェージュ生成 ──
+        logger.info("Step 11: Solfege generation")
+        # pretty_midi.Note を列ごとの配列にしてラベルをまとめて求め、dict は最後に1回だけ作る
+        notes_sorted = sorted(notes, key=attrgetter("start", "pitch"))
+        n_notes = len(notes_sorted)
+        starts = np.fromiter((n.start for n in notes_sorted), dtype=np.float64, count=n_notes)
+        ends = np.fromiter((n.end for n in notes_sorted), dtype=np.float64, count=n_notes)
+        pitches = np.fromiter((n.pitch for n in notes_sorted), dtype=np.int64, count=n_notes)
+        velocities = np.fromiter((n.velocity for n in notes_sorted), dtype=np.int64, count=n_notes)
+        solfege_labels, key_labels = label_notes(starts, pitches, key_sequence, grid_times_np)
+        note_events_with_solfege = [
+            {"start": s, "end": e, "pitch": p, "velocity": v, "solfege": solfege, "key": key}
+            for s, e, p, v, solfege, key in zip(
+                starts.tolist(), ends.tolist(), pitches.tolist(), velocities.tolist(),
+                solfege_labels, key_labels,
+            )
+        ]
+
+        # key_sequence 情報をリストに変換（JSON シリアライズ用）
+        # 時刻とラベルは配列演算でまとめて Python のリストにし、要素ごとの型変換を避ける
+        key_labels_seq = KEY_LABEL_ARRAY[np.asarray(key_sequence, dtype=np.intp)]
+        key_sequence_info = [
+            {"grid_time": t, "key": label}
+            for t, label in zip(grid_times_np.tolist(), key_labels_seq.tolist())
+        ]
+
+        solfege_json_path = artifacts_dir / "solfege.json"
+        _write_json(
+            solfege_json_path,
             {
                 "estimated_global_key": global_key.label,
                 "key_sequence": key_sequence_info,
                 "note_count": len(note_events_with_solfege),
                 "notes": note_events_with_solfege,
             },
-            f,
-            ensure_ascii=False,
-            indent=2,
         )
 
+        # 伴奏ミックスの書き出し (Step 10 の続き)
+        mix_audio = _mix_with_inst(y_inst, synth_future.result())
+        mix_path = artifacts_dir / "vocals_transcribed_with_inst.wav"
+        sf.write(str(mix_path), mix_audio, sr, subtype="PCM_16")
+
     logger.info("Transcription pipeline complete")
     return {
         "sample_rate": sr,